@@ -1,16 +1,20 @@
 import streamlit as st
+import asyncio
 import os
-from openai import OpenAI
+import threading
+from collections import deque
+from itertools import islice
 
 # ================= 🔧 配置区域 (CEO控制台) =================
 # API Key 从安全位置读取（优先级：Streamlit secrets > 环境变量）
-def get_api_key():
-    """安全地获取 API Key"""
+@st.cache_resource
+def _load_api_key():
+    """安全地获取 API Key（找到后每个进程只读取一次）"""
     # 优先从 Streamlit secrets 读取
     try:
         if hasattr(st, 'secrets') and 'deepseek' in st.secrets and 'api_key' in st.secrets.deepseek:
             return st.secrets.deepseek.api_key
-    except:
+    except (AttributeError, KeyError, FileNotFoundError):
         pass
     
     # 其次从环境变量读取
@@ -21,24 +25,78 @@ def get_api_key():
     # 如果都没有，返回 None（会在界面上提示用户配置）
     return None
 
+def get_api_key():
+    """获取 API Key；未找到时不缓存，配置好后刷新页面即可生效"""
+    api_key = _load_api_key()
+    if api_key is None:
+        _load_api_key.clear()
+    return api_key
+
 MY_API_KEY = get_api_key()
 
 # DeepSeek 官方配置
 MY_BASE_URL = "https://api.deepseek.com"
 MY_MODEL_NAME = "deepseek-chat"
+
+# 每次请求只携带最近的对话轮数（一问一答为一轮），控制上下文长度
+MAX_TURNS = 12
+# 每个会话在内存中最多保留的消息条数（system 提示词单独保存在 system_prompt 中）
+MAX_KEPT_MESSAGES = 60
 # ========================================================
 
+# 后台事件循环：所有会话共享，AsyncOpenAI 的连接池绑定在这个循环上
+@st.cache_resource
+def get_event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="joy-event-loop", daemon=True).start()
+    return loop
+
+def run_async(coro):
+    """在后台事件循环中执行协程，并等待结果"""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+_STREAM_END = object()
+
+async def _anext(agen):
+    try:
+        return await agen.__anext__()
+    except StopAsyncIteration:
+        return _STREAM_END
+
+def iter_async(agen):
+    """把异步生成器转换成普通生成器，供脚本线程逐段渲染"""
+    try:
+        while (item := run_async(_anext(agen))) is not _STREAM_END:
+            yield item
+    finally:
+        run_async(agen.aclose())
+
 # 初始化 AI 客户端
 @st.cache_resource
-def get_client():
-    if not MY_API_KEY:
+def get_client(api_key):
+    if not api_key:
         return None
-    return OpenAI(
-        api_key=MY_API_KEY,
-        base_url=MY_BASE_URL
+    # 延迟导入：openai/httpx 体积较大，未配置 Key 时无需加载（cache_resource 保证每个进程只导入一次）
+    import httpx
+    from openai import AsyncOpenAI
+    
+    # HTTP/2 + 长连接池：多次对话复用同一条 TCP/TLS 连接，省去每次握手
+    http_client = httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=40, keepalive_expiry=60.0)
+        ),
+        timeout=httpx.Timeout(60.0, connect=3.0)
+    )
+    # 重试由 create_completion 统一处理，关闭 SDK 自带的重试以免叠加
+    return AsyncOpenAI(
+        api_key=api_key,
+        base_url=MY_BASE_URL,
+        http_client=http_client,
+        max_retries=0
     )
 
-client = get_client()
+client = get_client(MY_API_KEY)
 
 # 🔮 注入灵魂 (这里决定了 AI 的说话风格)
 SYSTEM_PROMPT = """
@@ -57,40 +115,66 @@ SYSTEM_PROMPT = """
    - 例如："今晚把卧室的灯调暗"、"去摸摸路边的树叶"、"喝一杯温热的蜂蜜水"。
 """
 
-def get_constellation_element(constellation):
-    """获取星座元素"""
-    fire_signs = ['白羊', '狮子', '射手']
-    water_signs = ['巨蟹', '天蝎', '双鱼']
-    earth_signs = ['金牛', '处女', '摩羯']
-    air_signs = ['双子', '天秤', '水瓶']
+# 📝 API Key 配置说明（未配置 Key 时显示）
+API_KEY_HELP = """
+    ### 📝 配置方法（选择其一）：
+    
+    **方法 1：使用 Streamlit Secrets（推荐）**
+    1. 创建 `.streamlit/secrets.toml` 文件
+    2. 添加以下内容：
+    ```toml
+    [deepseek]
+    api_key = "sk-你的API密钥"
+    ```
     
-    if constellation in fire_signs:
-        return "火象星座"
-    elif constellation in water_signs:
-        return "水象星座"
-    elif constellation in earth_signs:
-        return "土象星座"
-    elif constellation in air_signs:
-        return "风象星座"
-    return "未知元素"
-
-def build_system_prompt(user_info):
-    """根据用户信息构建个性化的系统提示词"""
-    name = user_info.get("name", "朋友")
-    constellation = user_info.get("constellation", "")
-    birth_date = user_info.get("birth_date", "")
-    birth_time = user_info.get("birth_time", "")
+    **方法 2：使用环境变量**
+    1. 在终端中设置：
+    ```bash
+    # Windows PowerShell
+    $env:DEEPSEEK_API_KEY="sk-你的API密钥"
     
+    # Windows CMD
+    set DEEPSEEK_API_KEY=sk-你的API密钥
+    
+    # Linux/Mac
+    export DEEPSEEK_API_KEY="sk-你的API密钥"
+    ```
+    2. 然后运行 `streamlit run app.py`
+    
+    **获取 API Key**: https://platform.deepseek.com/api_keys
+    """
+
+# 星座选项（侧边栏下拉框顺序）及其在下拉框中的位置（0 为空选项）
+CONSTELLATION_OPTIONS = ('白羊', '金牛', '双子', '巨蟹', '狮子', '处女',
+                         '天秤', '天蝎', '射手', '摩羯', '水瓶', '双鱼')
+_CONS_INDEX = {c: i + 1 for i, c in enumerate(CONSTELLATION_OPTIONS)}
+
+# 星座 -> 元素 对照表
+_ELEMENT_BY_SIGN = {
+    **{sign: "火象星座" for sign in ('白羊', '狮子', '射手')},
+    **{sign: "水象星座" for sign in ('巨蟹', '天蝎', '双鱼')},
+    **{sign: "土象星座" for sign in ('金牛', '处女', '摩羯')},
+    **{sign: "风象星座" for sign in ('双子', '天秤', '水瓶')},
+}
+
+def get_constellation_element(constellation):
+    """获取星座元素"""
+    return _ELEMENT_BY_SIGN.get(constellation, "未知元素")
+
+@st.cache_data(show_spinner=False)
+def build_system_prompt(name="朋友", constellation="", birth_date="", birth_time=""):
+    """根据用户信息构建个性化的系统提示词（相同星盘信息复用缓存结果）"""
     element = get_constellation_element(constellation)
     
     # 构建星盘信息
-    astro_info = f"用户姓名：{name}\n星座：{constellation}"
+    parts = [f"用户姓名：{name}", f"星座：{constellation}"]
     if element:
-        astro_info += f"\n星座元素：{element}"
+        parts.append(f"星座元素：{element}")
     if birth_date:
-        astro_info += f"\n出生日期：{birth_date}"
+        parts.append(f"出生日期：{birth_date}")
     if birth_time:
-        astro_info += f"\n出生时间：{birth_time}"
+        parts.append(f"出生时间：{birth_time}")
+    astro_info = "\n".join(parts)
     
     personalized_prompt = f"""{SYSTEM_PROMPT}
 
@@ -109,28 +193,160 @@ def build_system_prompt(user_info):
 """
     return personalized_prompt
 
+def new_history():
+    """创建聊天历史：超过 MAX_KEPT_MESSAGES 条时自动丢弃最早的消息"""
+    return deque(maxlen=MAX_KEPT_MESSAGES)
+
 def init_session_state():
     """初始化 session state"""
-    if "user_info" not in st.session_state:
-        st.session_state.user_info = {}
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
-    if "system_prompt" not in st.session_state:
-        st.session_state.system_prompt = None
-
-def get_ai_response(user_input, messages):
-    """获取 AI 回复"""
+    ss = st.session_state
+    ss.setdefault("user_info", {})
+    ss.setdefault("messages", new_history())
+    ss.setdefault("system_prompt", None)
+
+def trim_messages(system_prompt, history):
+    """拼接 system 提示词和最近 MAX_TURNS 轮完整对话（以及待回复的新问题），得到发送给 API 的消息列表"""
+    start = len(history) - 2 * MAX_TURNS
+    # 末尾是待回复的用户消息时，多保留一条，保证窗口从一问一答的开头截断
+    if history and history[-1]["role"] == "user":
+        start -= 1
+    start = max(start, 0)
+    # 不发送问题已被截掉（或被 deque 淘汰）的孤立回复
+    if start < len(history) and history[start]["role"] == "assistant":
+        start += 1
+    return [{"role": "system", "content": system_prompt}] + list(islice(history, start, None))
+
+# 网络波动 / 限流 / 服务端 5xx 时的重试次数与退避基数（秒）
+MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.25
+
+async def create_completion(**kwargs):
+    """调用 chat.completions.create，遇到临时性错误时指数退避重试（Key 错误、参数错误不重试）"""
+    from openai import APIConnectionError, InternalServerError, RateLimitError
+    
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            return await client.chat.completions.create(model=MY_MODEL_NAME, **kwargs)
+        except (APIConnectionError, RateLimitError, InternalServerError):
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(RETRY_BASE_DELAY * 2 ** attempt)
+
+async def get_ai_response(user_input, messages):
+    """获取 AI 回复（流式，逐段返回文本）"""
     if not client:
-        return "❌ API Key 未配置，无法连接服务。"
+        yield "❌ API Key 未配置，无法连接服务。"
+        return
     try:
-        response = client.chat.completions.create(
-            model=MY_MODEL_NAME,
+        response = await create_completion(
             messages=messages,
+            stream=True
+        )
+        # 提前中断（重跑、点击侧边栏）时也要关闭流，及时归还连接池
+        async with response:
+            async for chunk in response:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+    except Exception as e:
+        yield f"❌ 连接波动: {str(e)}\n请检查 API Key 是否填对，或者余额是否充足。"
+
+async def get_ai_responses(messages, n=1):
+    """一次请求获取 n 种不同的回复（输入 token 只计费一次）"""
+    if not client:
+        return ["❌ API Key 未配置，无法连接服务。"]
+    try:
+        response = await create_completion(
+            messages=messages,
+            n=n,
             stream=False
         )
-        return response.choices[0].message.content
+        return [choice.message.content for choice in response.choices]
     except Exception as e:
-        return f"❌ 连接波动: {str(e)}\n请检查 API Key 是否填对，或者余额是否充足。"
+        return [f"❌ 连接波动: {str(e)}\n请检查 API Key 是否填对，或者余额是否充足。"]
+
+# 流式渲染：刷新间隔从 1 个片段逐步增长到 8 个，减少快速输出时的重绘次数
+STREAM_MIN_BATCH_SIZE = 1
+STREAM_MAX_BATCH_SIZE = 8
+
+def render_stream(chunks, placeholder_text="🔮 正在读取星盘能量..."):
+    """把流式片段写入占位符，返回完整回复"""
+    placeholder = st.empty()
+    placeholder.markdown(placeholder_text)
+    full = []
+    batch_size = STREAM_MIN_BATCH_SIZE
+    pending = 0
+    for delta in chunks:
+        full.append(delta)
+        pending += 1
+        if pending >= batch_size:
+            placeholder.markdown("".join(full))
+            pending = 0
+            batch_size = min(batch_size * 2, STREAM_MAX_BATCH_SIZE)
+    placeholder.markdown("".join(full))
+    return "".join(full)
+
+# st.fragment 需要 Streamlit >= 1.37（1.33 起为 experimental_fragment），旧版本退化为普通函数
+fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda func: func)
+
+def render_shell():
+    """页面标题"""
+    st.title("🔮 Joy 心灵疗愈师")
+    st.markdown("---")
+
+def render_help():
+    """API Key 未配置时的提示"""
+    st.error("⚠️ API Key 未配置！")
+    st.markdown(API_KEY_HELP)
+
+def render_history():
+    """显示聊天历史"""
+    ss = st.session_state
+    for message in ss.messages:
+        if message["role"] == "user":
+            with st.chat_message("user"):
+                st.write(message["content"])
+        elif message["role"] == "assistant":
+            with st.chat_message("assistant", avatar="🔮"):
+                st.write(message["content"])
+
+@fragment
+def render_chat():
+    """主聊天区域：历史消息、流式回复和"多种解读"按钮
+
+    fragment 只作用于"多种解读"按钮：点击时只重跑这一块；发送消息仍会整页重跑。
+    """
+    ss = st.session_state
+    # 显示欢迎信息（仅第一次）
+    if not ss.messages:
+        st.success(f"✨ 欢迎，{ss.user_info.get('name', '朋友')}！")
+        st.info("我已经读取了你的星盘能量，现在可以开始对话了。告诉我你的烦恼，我会结合你的星盘来为你解读。")
+    
+    render_history()
+    
+    # 最新一条是用户消息时，流式显示 AI 回复
+    if ss.messages and ss.messages[-1]["role"] == "user":
+        prompt = ss.messages[-1]["content"]
+        with st.chat_message("assistant", avatar="🔮"):
+            ai_reply = render_stream(iter_async(
+                get_ai_response(prompt, trim_messages(ss.system_prompt, ss.messages))
+            ))
+        
+        # 添加 AI 回复到历史
+        ss.messages.append({"role": "assistant", "content": ai_reply})
+    
+    # 针对最近一个问题，一次请求给出多种解读（刚生成的回复下方也要显示）
+    if ss.messages and ss.messages[-1]["role"] == "assistant":
+        if st.button("🎲 再给我几种解读"):
+            with st.spinner("🔮 正在读取星盘能量..."):
+                history = list(ss.messages)[:-1]
+                replies = run_async(get_ai_responses(trim_messages(ss.system_prompt, history), n=3))
+            tabs = st.tabs([f"解读 {i}" for i in range(1, len(replies) + 1)])
+            for tab, reply in zip(tabs, replies):
+                with tab:
+                    st.write(reply)
 
 # 页面配置
 st.set_page_config(
@@ -141,139 +357,82 @@ st.set_page_config(
 
 # 初始化
 init_session_state()
+ss = st.session_state
+
+# 标题（无论是否配置 Key 都先渲染，保持页面骨架稳定）
+render_shell()
 
 # 检查 API Key 是否配置
 if not MY_API_KEY:
-    st.error("⚠️ API Key 未配置！")
-    st.markdown("""
-    ### 📝 配置方法（选择其一）：
-    
-    **方法 1：使用 Streamlit Secrets（推荐）**
-    1. 创建 `.streamlit/secrets.toml` 文件
-    2. 添加以下内容：
-    ```toml
-    [deepseek]
-    api_key = "sk-你的API密钥"
-    ```
-    
-    **方法 2：使用环境变量**
-    1. 在终端中设置：
-    ```bash
-    # Windows PowerShell
-    $env:DEEPSEEK_API_KEY="sk-你的API密钥"
-    
-    # Windows CMD
-    set DEEPSEEK_API_KEY=sk-你的API密钥
-    
-    # Linux/Mac
-    export DEEPSEEK_API_KEY="sk-你的API密钥"
-    ```
-    2. 然后运行 `streamlit run app.py`
-    
-    **获取 API Key**: https://platform.deepseek.com/api_keys
-    """)
+    render_help()
     st.stop()
 
-# 标题
-st.title("🔮 Joy 心灵疗愈师")
-st.markdown("---")
-
 # 侧边栏 - 用户信息收集
 with st.sidebar:
     st.header("✨ 星盘能量收集")
     
     # 如果还没有收集用户信息，显示表单
-    if not st.session_state.user_info or not st.session_state.user_info.get("constellation"):
-        name = st.text_input("🌙 你的名字", value=st.session_state.user_info.get("name", ""))
+    if not ss.user_info or not ss.user_info.get("constellation"):
+        name = st.text_input("🌙 你的名字", value=ss.user_info.get("name", ""))
         if not name:
             name = "朋友"
         
-        constellation_options = ['白羊', '金牛', '双子', '巨蟹', '狮子', '处女', 
-                                '天秤', '天蝎', '射手', '摩羯', '水瓶', '双鱼']
         constellation = st.selectbox(
             "⭐ 你的星座",
-            options=[""] + constellation_options,
-            index=0 if not st.session_state.user_info.get("constellation") else 
-                  constellation_options.index(st.session_state.user_info.get("constellation", "")) + 1
+            options=[""] + list(CONSTELLATION_OPTIONS),
+            index=_CONS_INDEX.get(ss.user_info.get("constellation", ""), 0)
         )
         
         birth_date = st.text_input(
             "📅 出生日期 (可选)", 
-            value=st.session_state.user_info.get("birth_date", ""),
+            value=ss.user_info.get("birth_date", ""),
             placeholder="YYYY-MM-DD"
         )
         
         birth_time = st.text_input(
             "⏰ 出生时间 (可选)", 
-            value=st.session_state.user_info.get("birth_time", ""),
+            value=ss.user_info.get("birth_time", ""),
             placeholder="HH:MM"
         )
         
         if st.button("✨ 确认信息，开始疗愈", type="primary"):
             if constellation:
-                st.session_state.user_info = {
+                ss.user_info = {
                     "name": name,
                     "constellation": constellation,
                     "birth_date": birth_date,
                     "birth_time": birth_time
                 }
-                st.session_state.system_prompt = build_system_prompt(st.session_state.user_info)
-                st.session_state.messages = [
-                    {"role": "system", "content": st.session_state.system_prompt}
-                ]
+                ss.system_prompt = build_system_prompt(
+                    name, constellation, birth_date, birth_time
+                )
+                ss.messages = new_history()
                 st.rerun()
             else:
                 st.error("请至少选择你的星座！")
     else:
         # 显示已收集的信息
         st.success("✅ 星盘信息已收集")
-        st.info(f"**姓名**: {st.session_state.user_info.get('name', '朋友')}")
-        st.info(f"**星座**: {st.session_state.user_info.get('constellation', '')}")
-        if st.session_state.user_info.get('birth_date'):
-            st.info(f"**出生日期**: {st.session_state.user_info.get('birth_date')}")
-        if st.session_state.user_info.get('birth_time'):
-            st.info(f"**出生时间**: {st.session_state.user_info.get('birth_time')}")
+        lines = [f"**姓名**: {ss.user_info.get('name', '朋友')}", f"**星座**: {ss.user_info.get('constellation', '')}"]
+        if ss.user_info.get('birth_date'):
+            lines.append(f"**出生日期**: {ss.user_info.get('birth_date')}")
+        if ss.user_info.get('birth_time'):
+            lines.append(f"**出生时间**: {ss.user_info.get('birth_time')}")
+        st.info("\n\n".join(lines))
         
         if st.button("🔄 重新设置信息"):
-            st.session_state.user_info = {}
-            st.session_state.messages = []
-            st.session_state.system_prompt = None
+            ss.user_info = {}
+            ss.messages = new_history()
+            ss.system_prompt = None
             st.rerun()
 
 # 主聊天区域
-if st.session_state.user_info and st.session_state.user_info.get("constellation"):
-    # 显示欢迎信息（仅第一次）
-    if len(st.session_state.messages) == 1:  # 只有 system message
-        st.success(f"✨ 欢迎，{st.session_state.user_info.get('name', '朋友')}！")
-        st.info("我已经读取了你的星盘能量，现在可以开始对话了。告诉我你的烦恼，我会结合你的星盘来为你解读。")
-    
-    # 显示聊天历史
-    for message in st.session_state.messages:
-        if message["role"] == "system":
-            continue
-        elif message["role"] == "user":
-            with st.chat_message("user"):
-                st.write(message["content"])
-        elif message["role"] == "assistant":
-            with st.chat_message("assistant", avatar="🔮"):
-                st.write(message["content"])
-    
-    # 用户输入
+if ss.user_info and ss.user_info.get("constellation"):
+    # 用户输入：放在主体中（不放进 fragment），让输入框固定在页面底部
     if prompt := st.chat_input("告诉我你的烦恼..."):
-        # 添加用户消息
-        st.session_state.messages.append({"role": "user", "content": prompt})
-        with st.chat_message("user"):
-            st.write(prompt)
-        
-        # 显示思考中
-        with st.chat_message("assistant", avatar="🔮"):
-            with st.spinner("🔮 正在读取星盘能量..."):
-                # 获取 AI 回复
-                ai_reply = get_ai_response(prompt, st.session_state.messages)
-                st.write(ai_reply)
-        
-        # 添加 AI 回复到历史
-        st.session_state.messages.append({"role": "assistant", "content": ai_reply})
+        # 添加用户消息，由 render_chat 显示并生成回复
+        ss.messages.append({"role": "user", "content": prompt})
+    render_chat()
 else:
     # 提示用户先填写信息
     st.info("👈 请在左侧边栏填写你的星盘信息，然后开始对话。")
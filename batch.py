@@ -0,0 +1,119 @@
+"""
+离线批处理：把大量非交互请求（日记复盘、评估、回填等）交给 Batch API，
+不占用在线对话的 RPM 配额，价格约为同步调用的一半。
+Batch 任务通常需要数小时才能完成，不要在 app.py 的交互流程中使用。
+
+DeepSeek 官方接口没有 /v1/files 与 /v1/batches，所以必须通过环境变量
+BATCH_BASE_URL 指定支持 OpenAI 兼容 Batch API 的服务（必要时同时设置
+BATCH_API_KEY 与 BATCH_MODEL_NAME）。依赖 openai>=1.18.0。
+
+用法：
+    export BATCH_BASE_URL="https://你的-batch-服务/v1"
+    python batch.py submit prompts.jsonl   # 每行 {"custom_id": "...", "messages": [...]}
+    python batch.py poll <batch_id>        # 等待完成并打印结果
+"""
+import argparse
+import json
+import os
+import time
+
+# ================= 🔧 配置区域 =================
+# 需要服务端支持 OpenAI 兼容的 /v1/files 与 /v1/batches 接口
+BATCH_API_KEY = os.getenv('BATCH_API_KEY') or os.getenv('DEEPSEEK_API_KEY')
+BATCH_BASE_URL = os.getenv('BATCH_BASE_URL')
+BATCH_MODEL_NAME = os.getenv('BATCH_MODEL_NAME', "deepseek-chat")
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+# 轮询间隔（秒）
+POLL_INTERVAL = 60
+# ===============================================
+
+def get_client():
+    """创建批处理用的客户端"""
+    from openai import OpenAI
+    if not BATCH_API_KEY:
+        raise RuntimeError("未配置 API Key：请设置 BATCH_API_KEY 或 DEEPSEEK_API_KEY 环境变量")
+    if not BATCH_BASE_URL:
+        raise RuntimeError("未配置 Batch 服务地址：请设置 BATCH_BASE_URL 环境变量（DeepSeek 官方接口不支持 Batch API）")
+    return OpenAI(api_key=BATCH_API_KEY, base_url=BATCH_BASE_URL)
+
+def build_batch_jsonl(prompts):
+    """把 [{"custom_id", "messages"}, ...] 转成 Batch API 需要的 JSONL"""
+    lines = []
+    for prompt in prompts:
+        lines.append(json.dumps({
+            "custom_id": prompt["custom_id"],
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": {
+                "model": prompt.get("model", BATCH_MODEL_NAME),
+                "messages": prompt["messages"]
+            }
+        }, ensure_ascii=False))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+def enqueue_batch(prompts, client=None):
+    """上传请求文件并创建 Batch 任务，返回 batch id"""
+    client = client or get_client()
+    input_file = client.files.create(
+        file=("batch_input.jsonl", build_batch_jsonl(prompts)),
+        purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=BATCH_COMPLETION_WINDOW
+    )
+    return batch.id
+
+def fetch_batch_results(batch_id, client=None):
+    """读取 Batch 结果：未完成返回 None，完成后返回 {custom_id: 回复内容}"""
+    client = client or get_client()
+    batch = client.batches.retrieve(batch_id)
+    if batch.status in ("failed", "expired", "cancelled"):
+        raise RuntimeError(f"Batch {batch_id} 状态异常: {batch.status}")
+    if batch.status != "completed":
+        return None
+
+    results = {}
+    if not batch.output_file_id:
+        return results
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        response = row.get("response") or {}
+        if response.get("status_code") == 200:
+            results[row["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        else:
+            results[row["custom_id"]] = None
+    return results
+
+def wait_for_batch(batch_id, client=None, poll_interval=POLL_INTERVAL):
+    """轮询直到 Batch 完成，返回结果"""
+    client = client or get_client()
+    while True:
+        results = fetch_batch_results(batch_id, client)
+        if results is not None:
+            return results
+        time.sleep(poll_interval)
+
+def main():
+    parser = argparse.ArgumentParser(description="Joy 离线批处理")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    submit_parser = subparsers.add_parser("submit", help="提交 JSONL 请求文件")
+    submit_parser.add_argument("path")
+    poll_parser = subparsers.add_parser("poll", help="等待 Batch 完成并输出结果")
+    poll_parser.add_argument("batch_id")
+    args = parser.parse_args()
+
+    if args.command == "submit":
+        with open(args.path, encoding="utf-8") as f:
+            prompts = [json.loads(line) for line in f if line.strip()]
+        print(enqueue_batch(prompts))
+    else:
+        for custom_id, content in wait_for_batch(args.batch_id).items():
+            print(json.dumps({"custom_id": custom_id, "content": content}, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
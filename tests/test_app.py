@@ -0,0 +1,82 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("openai")
+AppTest = pytest.importorskip("streamlit.testing.v1").AppTest
+
+import openai
+import streamlit as st
+
+APP_PATH = str(Path(__file__).resolve().parent.parent / "app.py")
+REGENERATE_LABEL = "🎲 再给我几种解读"
+
+
+class FakeStream:
+    """模拟 AsyncStream：逐段返回回复内容"""
+
+    def __init__(self, deltas):
+        self._deltas = iter(deltas)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            delta = next(self._deltas)
+        except StopIteration:
+            raise StopAsyncIteration
+        return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=delta))])
+
+
+class FakeCompletions:
+    async def create(self, model, messages, stream=False, n=1):
+        if stream:
+            return FakeStream(["亲爱的", "朋友，", "先深呼吸。"])
+        return SimpleNamespace(choices=[
+            SimpleNamespace(message=SimpleNamespace(content=f"解读内容 {i}")) for i in range(1, n + 1)
+        ])
+
+
+class FakeAsyncOpenAI:
+    def __init__(self, **kwargs):
+        self.chat = SimpleNamespace(completions=FakeCompletions())
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setenv("DEEPSEEK_API_KEY", "sk-test")
+    monkeypatch.setattr(openai, "AsyncOpenAI", FakeAsyncOpenAI)
+    st.cache_resource.clear()
+    st.cache_data.clear()
+
+    at = AppTest.from_file(APP_PATH, default_timeout=10)
+    at.run()
+    at.sidebar.selectbox[0].select("白羊")
+    at.sidebar.button[0].click().run()
+    return at
+
+
+def regenerate_buttons(at):
+    return [button for button in at.main.button if button.label == REGENERATE_LABEL]
+
+
+def test_regenerate_button_shown_right_after_each_reply(app):
+    for question in ("我最近很累", "工作不顺利", "睡不着"):
+        app.chat_input[0].set_value(question).run()
+        assert app.session_state.messages[-1]["content"] == "亲爱的朋友，先深呼吸。"
+        assert len(regenerate_buttons(app)) == 1
+
+
+def test_regenerate_button_shows_three_readings(app):
+    app.chat_input[0].set_value("我最近很累").run()
+    regenerate_buttons(app)[0].click().run()
+    assert len(app.tabs) == 3
+    assert [tab.label for tab in app.tabs] == ["解读 1", "解读 2", "解读 3"]